@@ -1,21 +1,90 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import datetime
+import hashlib
+import io
 import os
-import pickle
+import sqlite3
+import subprocess
 import urllib.parse
-from typing import Generator, Optional, Tuple
+import zlib
+from typing import Dict, Generator, Iterable, Optional, Set, Tuple
 
-import graphviz
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
 
 from atlassian import Confluence
 
+# (fact type, source object type, destination object type, bidirectional)
+FactBinding = Tuple[str, str, Optional[str], bool]
+# (fact type, source, destination, bidirectional) of facts binding two objects
+DoubleFactBinding = Tuple[str, str, str, bool]
+# (fact type, source object type) of facts binding a single object
+SingleFactBinding = Tuple[str, str]
+
+# (etag, last modified, content hash)
+CacheEntry = Tuple[Optional[str], Optional[str], str]
+
+
+class ResponseCache:
+    """Cache of api responses in a sqlite database, keyed by url"""
+
+    def __init__(self, filename: str) -> None:
+        self._db = sqlite3.connect(filename)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache("
+            "url TEXT PRIMARY KEY, "
+            "etag TEXT, "
+            "last_modified TEXT, "
+            "content_hash TEXT, "
+            "body BLOB)"
+        )
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        """Look up the validators and content hash of url, without the body"""
+
+        return self._db.execute(
+            "SELECT etag, last_modified, content_hash FROM cache WHERE url = ?", (url,)
+        ).fetchone()
+
+    def body(self, url: str) -> Optional[bytes]:
+        """Look up the cached response body of url"""
+
+        row = self._db.execute(
+            "SELECT body FROM cache WHERE url = ?", (url,)
+        ).fetchone()
+        return zlib.decompress(row[0]) if row else None
+
+    def store(
+        self,
+        url: str,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        content_hash: str,
+        body: bytes,
+    ) -> None:
+        """Store the response of url, replacing any previous response"""
+
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (url, etag, last_modified, content_hash, zlib.compress(body)),
+            )
+
+    def close(self) -> None:
+        self._db.close()
+
 
 class DataModel:
 
     DEBUG = False
+    # (connect, read) timeout of requests to the act instance, in seconds
+    TIMEOUT = (3.05, 30)
 
     def __init__(
         self,
@@ -33,23 +102,143 @@ class DataModel:
         self.status: Optional[int] = None
         self._objects: Optional[dict] = None
         self._facts: Optional[dict] = None
+        self._facts_cache: Optional[Tuple[FactBinding, ...]] = None
+        self._double_facts: Tuple[DoubleFactBinding, ...] = ()
+        self._double_facts_no_mentions: Tuple[DoubleFactBinding, ...] = ()
+        self._single_facts: Tuple[SingleFactBinding, ...] = ()
+        self._objects_hash: Optional[str] = None
+        self._facts_hash: Optional[str] = None
+        self.not_modified = False
         self.verify = cacert if cacert != "" else True
+        self._session = self._make_session()
+
+    def _make_session(self) -> requests.Session:
+        """Create a pooled http session shared by all requests to the act instance"""
+
+        session = requests.Session()
+        # Read timeouts are not retried, so they reach _get as ReadTimeout and
+        # the cached response can be used instead
+        retries = Retry(
+            total=3,
+            read=False,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.auth = (self.username, self.password) if self.username else None
+        session.headers.update(
+            {"ACT-User-ID": str(self.user_id), "Accept": "application/json"}
+        )
+        session.verify = self.verify
+        return session
 
-    def load(self) -> None:
-        """Download the datamodel from the act instance"""
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_session"]
+        return state
 
-        headers = {"ACT-User-ID": str(self.user_id), "Accept": "application/json"}
-        auth = (self.username, self.password)
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._session = self._make_session()
 
-        if self.username:
-            r = requests.get(
-                self.objects_url, auth=auth, headers=headers, verify=self.verify
+    def _get(
+        self, url: str, entry: Optional[CacheEntry]
+    ) -> Optional[requests.Response]:
+        """GET url from the act instance using the shared session
+
+        Returns None if the read times out and a cached response of url exists"""
+
+        try:
+            return self._session.get(
+                url, headers=self._conditional_headers(entry), timeout=self.TIMEOUT
             )
-        else:
-            r = requests.get(self.objects_url, headers=headers, verify=self.verify)
+        except (
+            requests.exceptions.ReadTimeout,
+            requests.exceptions.ConnectionError,
+        ) as e:
+            if entry is None or not self._is_read_timeout(e):
+                raise
+            if self.DEBUG:
+                print("Timeout loading {}, using cached response".format(url))
+            return None
+
+    @staticmethod
+    def _is_read_timeout(e: requests.exceptions.RequestException) -> bool:
+        """Whether e was caused by a read timeout
+
+        A read timeout while downloading the body is raised as a ConnectionError
+        wrapping the urllib3 ReadTimeoutError, possibly inside a MaxRetryError"""
+
+        if isinstance(e, requests.exceptions.ReadTimeout):
+            return True
+        cause = e.args[0] if e.args else None
+        cause = getattr(cause, "reason", cause)
+        return isinstance(cause, ReadTimeoutError)
+
+    @staticmethod
+    def _conditional_headers(entry: Optional[CacheEntry]) -> Dict[str, str]:
+        """Build If-None-Match/If-Modified-Since headers from a cache entry"""
+
+        headers: Dict[str, str] = {}
+        if not entry:
+            return headers
+        etag, last_modified, _ = entry
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    @staticmethod
+    def _from_cache(r: Optional[requests.Response]) -> bool:
+        """Whether the cached response should be used instead of r"""
+
+        return r is None or r.status_code == 304
+
+    def load(self, cache: Optional[ResponseCache] = None) -> None:
+        """Download the datamodel from the act instance
+
+        If a response cache is given, conditional requests are issued and
+        cached responses are used for endpoints that answer 304 Not Modified
+        or time out.
+        not_modified is set if the content of neither endpoint has changed
+        since it was cached, and if neither endpoint answered 200 no data is
+        loaded at all."""
+
+        self._facts_cache = None
+        self._double_facts = ()
+        self._double_facts_no_mentions = ()
+        self._single_facts = ()
+        self.not_modified = False
+
+        objects_entry = cache.get(self.objects_url) if cache else None
+        facts_entry = cache.get(self.facts_url) if cache else None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            objects_future = executor.submit(self._get, self.objects_url, objects_entry)
+            facts_future = executor.submit(self._get, self.facts_url, facts_entry)
+            objects_r = objects_future.result()
+            facts_r = facts_future.result()
+
+        if self._from_cache(objects_r) and self._from_cache(facts_r):
+            self._objects_hash = objects_entry[2]
+            self._facts_hash = facts_entry[2]
+            self.not_modified = True
+            self.status = 304
+            return
 
-        if r.status_code == 200:
-            self._objects = r.json()
+        r = objects_r
+
+        if self._from_cache(r):
+            self._objects = orjson.loads(cache.body(self.objects_url))
+            self._objects_hash = objects_entry[2]
+        elif r.status_code == 200:
+            self._objects = orjson.loads(r.content)
+            self._objects_hash = self._hash(self._objects)
         else:
             if self.DEBUG:
                 print("Error loading objects: {}".format(r.status_code))
@@ -58,52 +247,127 @@ class DataModel:
             self.status = r.status_code
             return
 
-        if self.username:
-            r = requests.get(
-                self.facts_url, auth=auth, headers=headers, verify=self.verify
-            )
-        else:
-            r = requests.get(self.facts_url, headers=headers, verify=self.verify)
+        r = facts_r
 
-        if r.status_code == 200:
-            self._facts = r.json()
+        if self._from_cache(r):
+            self._facts = orjson.loads(cache.body(self.facts_url))
+            self._facts_hash = facts_entry[2]
+        elif r.status_code == 200:
+            self._facts = orjson.loads(r.content)
+            self._facts_hash = self._hash(self._facts)
         else:
             if self.DEBUG:
-                print("Error loading objects: {}".format(r.status_code))
+                print("Error loading facts: {}".format(r.status_code))
             self._objects = None
             self._facts = None
             self.status = r.status_code
             return
 
-        self.status = r.status_code
+        # Only cache the responses once both endpoints are loaded, so a failed
+        # load is retried in full on the next run
+        if cache:
+            for url, response, content_hash in (
+                (self.objects_url, objects_r, self._objects_hash),
+                (self.facts_url, facts_r, self._facts_hash),
+            ):
+                if not self._from_cache(response):
+                    cache.store(
+                        url,
+                        response.headers.get("ETag"),
+                        response.headers.get("Last-Modified"),
+                        content_hash,
+                        response.content,
+                    )
+
+        self.not_modified = (
+            objects_entry is not None
+            and facts_entry is not None
+            and self._objects_hash == objects_entry[2]
+            and self._facts_hash == facts_entry[2]
+        )
+        self._split_facts()
+        self.status = 200
+
+    @staticmethod
+    def _hash(data: dict) -> str:
+        """Content hash of a decoded api response"""
+
+        return hashlib.blake2b(
+            orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
 
     def __eq__(self, other: object) -> bool:
-        return set(self.objects) == set(other.objects) and set(self.facts) == set(
-            other.facts
+        if not isinstance(other, DataModel):
+            return NotImplemented
+        return (
+            self._objects_hash == other._objects_hash
+            and self._facts_hash == other._facts_hash
         )
 
     @property
-    def facts(self) -> Generator[Tuple[str, str, str, bool], None, None]:
-        """Iterate over fact bindings"""
+    def facts(self) -> Tuple[FactBinding, ...]:
+        """Fact bindings, parsed once and cached"""
+
+        if self._facts_cache is None:
+            if not self._facts:
+                if self.DEBUG:
+                    print("Trying to iterate over None facts")
+                return ()
+            self._facts_cache = tuple(self._iter_facts())
+        return self._facts_cache
+
+    @property
+    def double_facts(self) -> Tuple[DoubleFactBinding, ...]:
+        """Bindings of facts between two objects"""
+
+        return self._double_facts
+
+    @property
+    def double_facts_no_mentions(self) -> Tuple[DoubleFactBinding, ...]:
+        """Bindings of facts between two objects, except mentions"""
+
+        return self._double_facts_no_mentions
+
+    @property
+    def single_facts(self) -> Tuple[SingleFactBinding, ...]:
+        """Bindings of facts with a single object"""
+
+        return self._single_facts
+
+    def _split_facts(self) -> None:
+        """Split the fact bindings by whether they bind one or two objects
+
+        Bindings between two objects are also collected without mentions,
+        which are left out of the double edge graph"""
+
+        double_facts = []
+        double_facts_no_mentions = []
+        single_facts = []
+        for name, s, d, di in self.facts:
+            if d:
+                double_facts.append((name, s, d, di))
+                if name != "mentions":
+                    double_facts_no_mentions.append((name, s, d, di))
+            else:
+                single_facts.append((name, s))
+        self._double_facts = tuple(double_facts)
+        self._double_facts_no_mentions = tuple(double_facts_no_mentions)
+        self._single_facts = tuple(single_facts)
+
+    def _iter_facts(self) -> Generator[FactBinding, None, None]:
+        """Iterate over the fact bindings of the raw api response"""
 
-        if not self._facts:
-            if self.DEBUG:
-                print("Trying to iterate over None facts")
-            return
         for fact in self._facts["data"]:
             if not fact:
                 print("Nonetype", fact)
                 continue
-            bindings = fact["relevantObjectBindings"]
-            if not bindings:
-                continue
-            for binding in bindings:
+            name = fact["name"]
+            for binding in fact.get("relevantObjectBindings") or ():
+                destination = binding.get("destinationObjectType")
                 yield (
-                    fact["name"],
+                    name,
                     binding["sourceObjectType"]["name"],
-                    binding["destinationObjectType"]["name"]
-                    if binding["destinationObjectType"]
-                    else None,
+                    destination["name"] if destination else None,
                     binding["bidirectionalBinding"],
                 )
 
@@ -157,98 +421,179 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def run() -> None:
-    """Main program loop"""
+def quote(identifier: str) -> str:
+    """Quote identifier as a dot string"""
 
-    args = parse_args()
+    return '"{}"'.format(identifier.replace('"', '\\"'))
 
-    dm = DataModel(
-        args.url, args.http_username, args.http_password, args.uid, args.cacert
-    )
-    dm.load()
 
-    if dm.status != 200:
-        print("{} Status code {}".format(str(datetime.datetime.now()), dm.status))
-        return
+def build_double(
+    comment: str,
+    facts: Iterable[DoubleFactBinding],
+    objects: Optional[Iterable[str]] = None,
+) -> str:
+    """Build the dot source of a graph of the facts binding two objects
 
-    try:
-        old_dm = pickle.load(open("cache.dat", "rb"))
-        if old_dm == dm:
-            return
-    except FileNotFoundError:
-        print("First run")
+    If objects is given, all object types are included as nodes, not only
+    those bound by a fact"""
 
-    print("{} Graphing changes".format(str(datetime.datetime.now())))
+    buf = io.StringIO()
+    buf.write("// {}\ndigraph {{\n".format(comment))
+    # Nodes already emitted, to avoid repeating node statements
+    seen: Set[str] = set()
+
+    if objects:
+        for obj in objects:
+            if obj not in seen:
+                buf.write("\t{0} [label={0}]\n".format(quote(obj)))
+                seen.add(obj)
+
+    for name, s, d, di in facts:
+        if s not in seen:
+            buf.write("\t{0} [label={0}]\n".format(quote(s)))
+            seen.add(s)
+        if d not in seen:
+            buf.write("\t{0} [label={0}]\n".format(quote(d)))
+            seen.add(d)
+        buf.write(
+            "\t{} -> {} [label={}{}]\n".format(
+                quote(s), quote(d), quote(name), " dir=both" if di else ""
+            )
+        )
 
-    pickle.dump(dm, open("cache.dat", "wb"))
+    buf.write("}\n")
+    return buf.getvalue()
 
-    dot = graphviz.Digraph(comment="Double edge facts")
 
-    # for obj in dm.objects:
-    #     dot.node(obj, obj)
+def build_single(comment: str, facts: Iterable[SingleFactBinding]) -> str:
+    """Build the dot source of a graph of the facts binding a single object"""
 
-    for fact in dm.facts:
-        name, s, d, di = fact
-        if name == "mentions":
-            continue
-        if not d:
-            continue
+    buf = io.StringIO()
+    buf.write("// {}\ndigraph {{\n".format(comment))
+    # Fact type nodes are tracked separately, so a diamond keeps its shape even
+    # if an object type has the same name
+    seen_facts: Set[str] = set()
+    seen: Set[str] = set()
 
-        dot.node(s, s)
-        dot.node(d, d)
-        if di:
-            dot.edge(s, d, label=name, dir="both")
-        else:
-            dot.edge(s, d, label=name)
+    for name, s in facts:
+        if name not in seen_facts:
+            buf.write("\t{0} [label={0} shape=diamond]\n".format(quote(name)))
+            seen_facts.add(name)
+        if s not in seen:
+            buf.write("\t{0} [label={0}]\n".format(quote(s)))
+            seen.add(s)
+        buf.write("\t{} -> {}\n".format(quote(s), quote(name)))
 
-    if args.dump_source:
-        with open(os.path.join(args.dump_source, "double.dot"), "w") as f:
-            f.write(dot.source)
+    buf.write("}\n")
+    return buf.getvalue()
 
-    dot.render("output/double", format="png", renderer="cairo")
 
-    dot = graphviz.Digraph(comment="Single edge facts")
+def render_inline(source: str, out_path: str) -> subprocess.Popen:
+    """Start a dot process rendering source to out_path, feeding it on stdin
 
-    for fact in dm.facts:
+    The caller must wait for the returned process"""
 
-        name, s, d, di = fact
+    p = subprocess.Popen(["dot", "-Tpng:cairo", "-o", out_path], stdin=subprocess.PIPE)
+    p.stdin.write(source.encode())
+    p.stdin.close()
+    return p
 
-        if d:
-            continue
 
-        dot.node(name, label=name, shape="diamond")
-        dot.node(s, s)
+def render(graphs: Dict[str, str], dump_source: Optional[str]) -> None:
+    """Render the dot sources to output/<filename>.cairo.png, optionally dumping them
 
-        dot.edge(s, name)
+    Graphs whose source is unchanged since the last render, as recorded in
+    output/<filename>.hash, are skipped. When dumping the source, the graphs
+    are saved to output/<filename> and rendered by a single dot process,
+    otherwise the source is piped directly to one dot process per graph."""
 
-    if args.dump_source:
-        with open(os.path.join(args.dump_source, "single.dot"), "w") as f:
-            f.write(dot.source)
+    changed: Dict[str, str] = {}
 
-    dot.render("output/single", format="png", renderer="cairo")
+    for filename, source in graphs.items():
+        if dump_source:
+            with open(os.path.join(dump_source, filename + ".dot"), "w") as f:
+                f.write(source)
 
-    dot = graphviz.Digraph(comment="All Double edge facts")
+        source_hash = hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
 
-    for obj in dm.objects:
-        dot.node(obj, obj)
+        try:
+            with open(os.path.join("output", filename + ".hash")) as f:
+                if f.read().strip() == source_hash and os.path.exists(
+                    os.path.join("output", filename + ".cairo.png")
+                ):
+                    continue
+        except FileNotFoundError:
+            pass
 
-    for fact in dm.facts:
-        name, s, d, di = fact
-        if not d:
-            continue
+        changed[filename] = source_hash
 
-        dot.node(s, s)
-        dot.node(d, d)
-        if di:
-            dot.edge(s, d, label=name, dir="both")
-        else:
-            dot.edge(s, d, label=name)
+    if not changed:
+        return
+
+    os.makedirs("output", exist_ok=True)
+
+    if dump_source:
+        for filename in changed:
+            with open(os.path.join("output", filename), "w") as f:
+                f.write(graphs[filename])
+
+        subprocess.run(
+            ["dot", "-Tpng:cairo", "-O"]
+            + [os.path.join("output", filename) for filename in changed],
+            check=True,
+        )
+    else:
+        processes = [
+            render_inline(
+                graphs[filename], os.path.join("output", filename + ".cairo.png")
+            )
+            for filename in changed
+        ]
+        for p in processes:
+            if p.wait() != 0:
+                raise subprocess.CalledProcessError(p.returncode, p.args)
+
+    for filename, source_hash in changed.items():
+        with open(os.path.join("output", filename + ".hash"), "w") as f:
+            f.write(source_hash)
+
+
+def run() -> None:
+    """Main program loop"""
+
+    args = parse_args()
+
+    dm = DataModel(
+        args.url, args.http_username, args.http_password, args.uid, args.cacert
+    )
+    if not os.path.exists("cache.sqlite"):
+        print("First run")
+
+    cache = ResponseCache("cache.sqlite")
+    try:
+        dm.load(cache)
+    finally:
+        cache.close()
+
+    if dm.status not in (200, 304):
+        print("{} Status code {}".format(str(datetime.datetime.now()), dm.status))
+        return
+
+    if dm.not_modified:
+        return
+
+    print("{} Graphing changes".format(str(datetime.datetime.now())))
 
-    if args.dump_source:
-        with open(os.path.join(args.dump_source, "complete.dot"), "w") as f:
-            f.write(dot.source)
+    dot_double = build_double("Double edge facts", dm.double_facts_no_mentions)
+    dot_single = build_single("Single edge facts", dm.single_facts)
+    dot_complete = build_double(
+        "All Double edge facts", dm.double_facts, objects=dm.objects
+    )
 
-    dot.render("output/complete", format="png", renderer="cairo")
+    render(
+        {"double": dot_double, "single": dot_single, "complete": dot_complete},
+        args.dump_source,
+    )
 
     if args.parent_id:
         try:
@@ -268,38 +613,31 @@ def run() -> None:
             password=args.confluence_password,
             verify_ssl=verify_ssl,
         )
-        confluence.attach_file(
-            "output/double.cairo.png",
-            page_id=args.parent_id,
-            title="Double Edged Facts",
-        )
-        confluence.attach_file(
-            "output/single.cairo.png",
-            page_id=args.parent_id,
-            title="Single Edged Facts",
-        )
-        confluence.attach_file(
-            "output/complete.cairo.png",
-            page_id=args.parent_id,
-            title="Single Edged Facts",
-        )
+        uploads = [
+            ("output/double.cairo.png", "Double Edged Facts"),
+            ("output/single.cairo.png", "Single Edged Facts"),
+            ("output/complete.cairo.png", "Single Edged Facts"),
+        ]
 
         if args.dump_source:
-            confluence.attach_file(
-                os.path.join(args.dump_source, "complete.dot"),
-                page_id=args.parent_id,
-                title="complete source",
-            )
-            confluence.attach_file(
-                os.path.join(args.dump_source, "double.dot"),
-                page_id=args.parent_id,
-                title="double source",
-            )
-            confluence.attach_file(
-                os.path.join(args.dump_source, "single.dot"),
-                page_id=args.parent_id,
-                title="single source",
-            )
+            uploads += [
+                (os.path.join(args.dump_source, "complete.dot"), "complete source"),
+                (os.path.join(args.dump_source, "double.dot"), "double source"),
+                (os.path.join(args.dump_source, "single.dot"), "single source"),
+            ]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(
+                    confluence.attach_file,
+                    filename,
+                    page_id=args.parent_id,
+                    title=title,
+                )
+                for filename, title in uploads
+            ]
+            for future in futures:
+                future.result()
 
 
 if __name__ == "__main__":
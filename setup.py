@@ -35,7 +35,8 @@ setup(
     install_requires=[
         "act-api>=2.1.0,<2.2.0",
         "requests",
-        "graphviz",
+        "urllib3>=1.26",
+        "orjson",
         "atlassian-python-api",
     ],
     python_requires=">=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, <4",
@@ -0,0 +1,79 @@
+import socket
+import threading
+from typing import Iterator
+
+import pytest
+import requests
+
+from act.utils.graph_datamodel import DataModel
+
+CACHE_ENTRY = ("etag", None, "hash")
+
+
+def serve(reply: bytes) -> Iterator[str]:
+    """Accept connections on a local socket, send reply and never respond further"""
+
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(16)
+    conns = []
+
+    def accept() -> None:
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            conns.append(conn)
+            conn.recv(65536)
+            if reply:
+                conn.sendall(reply)
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(srv.getsockname()[1])
+    srv.close()
+    for conn in conns:
+        conn.close()
+
+
+@pytest.fixture
+def silent_server() -> Iterator[str]:
+    yield from serve(b"")
+
+
+@pytest.fixture
+def stalled_body_server() -> Iterator[str]:
+    yield from serve(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n{")
+
+
+@pytest.fixture(autouse=True)
+def short_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(DataModel, "TIMEOUT", (1, 0.2))
+
+
+@pytest.mark.parametrize("server", ["silent_server", "stalled_body_server"])
+def test_read_timeout_uses_cache(server: str, request: pytest.FixtureRequest) -> None:
+    dm = DataModel(request.getfixturevalue(server))
+
+    assert dm._get(dm.objects_url, CACHE_ENTRY) is None
+
+
+@pytest.mark.parametrize("server", ["silent_server", "stalled_body_server"])
+def test_read_timeout_without_cache_raises(
+    server: str, request: pytest.FixtureRequest
+) -> None:
+    dm = DataModel(request.getfixturevalue(server))
+
+    with pytest.raises(requests.exceptions.RequestException):
+        dm._get(dm.objects_url, None)
+
+
+def test_connection_refused_raises() -> None:
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    dm = DataModel("http://127.0.0.1:{}".format(port))
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        dm._get(dm.objects_url, CACHE_ENTRY)